@@ -0,0 +1,11 @@
+# Production server: gunicorn -c gunicorn.conf.py main:app
+# The gevent worker monkey-patches sockets at startup (before main is
+# imported), so many slow clients can be held open per worker. SQLite queries
+# still block the worker (sqlite3 is a C extension gevent can't patch), and
+# SMS are sent by the Celery worker, not here.
+import os
+
+bind = os.getenv("BIND", "0.0.0.0:5000")
+worker_class = "gevent"
+workers = int(os.getenv("WEB_CONCURRENCY", 4))
+worker_connections = 200
@@ -1,17 +1,94 @@
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, request, jsonify, send_from_directory
+from flask.json.provider import DefaultJSONProvider
+from flask.logging import default_handler
+from werkzeug.exceptions import NotFound
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
+from sqlalchemy import func, case, insert, update, event, text, select, lambda_stmt, literal, exists
+from sqlalchemy.engine import Engine
+from datetime import datetime, timedelta
 import os
+import sqlite3
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+from cachetools import TTLCache
+import orjson
 from twilio.rest import Client
+from twilio.http.http_client import TwilioHttpClient
+from twilio.base.exceptions import TwilioRestException
 from flask_cors import CORS
+from celery import Celery, group
+
+
+class ORJSONProvider(DefaultJSONProvider):
+    """jsonify/request.get_json backed by orjson"""
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
+
+# Log records go onto a queue and a background thread writes them, so request
+# handlers never block on stdout/stderr. Formatting (msg % args) still happens
+# on the calling thread in QueueHandler.prepare().
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter("%(message)s"))
+_log_queue_handler = logging.handlers.QueueHandler(queue.Queue(-1))
+_log_listener = None
+
+def _start_log_listener():
+    """(Re)start the listener thread - threads don't survive fork, so forked
+    workers (Celery prefork, gunicorn) get a fresh queue and listener"""
+    global _log_listener
+    _log_queue_handler.queue = queue.Queue(-1)
+    _log_listener = logging.handlers.QueueListener(_log_queue_handler.queue, _log_handler)
+    _log_listener.start()
+
+_start_log_listener()
+os.register_at_fork(after_in_child=_start_log_listener)
+atexit.register(lambda: _log_listener.stop())
+app.logger.removeHandler(default_handler)
+app.logger.addHandler(_log_queue_handler)
+app.logger.setLevel(logging.INFO)
 CORS(app)
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///proto.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Greenlets under gunicorn+gevent share the pool. Pre-ping (a SELECT 1 per
+# checkout) only pays off for a networked database - a local SQLite file has
+# no dead connections to drop.
+if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_pre_ping': True}
 db = SQLAlchemy(app)
 
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """WAL lets the admin views read while sensor events are being written"""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")  # 256MB
+    cursor.execute("PRAGMA cache_size=-20000")  # ~20MB page cache
+    cursor.close()
+
+# ---- Task Queue ----
+# SMS delivery runs on a Celery worker so /api/event doesn't wait on Twilio.
+# Run alongside Flask with: celery -A main.celery worker -Q alerts -c 8
+celery = Celery('lghacks', broker=os.getenv("CELERY_BROKER_URL", "redis://localhost:6379/0"))
+celery.conf.task_routes = {'main.send_sms': {'queue': 'alerts'}}  # critical alerts get their own queue
+# Twilio allows ~1 SMS/sec per long-code number and every SMS goes out from
+# TWILIO_FROM, so pace sends instead of bursting into 429s. Celery applies
+# this per worker node - run a single alerts worker.
+celery.conf.task_annotations = {'main.send_sms': {'rate_limit': '1/s'}}
+
 # ---- DB Models ----
 class Device(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -28,34 +105,115 @@ class NGO(db.Model):
     services = db.Column(db.String)
 
 class Event(db.Model):
+    # /admin/events orders by created_at, /admin/stats counts by status
+    __table_args__ = (
+        db.Index('ix_events_status_created', 'status', 'created_at'),
+        db.Index('ix_events_device_created', 'device_id', 'created_at'),  # per-device debounce
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     device_id = db.Column(db.String)
     event_type = db.Column(db.String)
     raw = db.Column(db.String)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     matched_ngos = db.Column(db.String)
     status = db.Column(db.String, default="new")
 
+# ---- Spatial Index ----
+# Each NGO with a location gets a bounding box (its service area) in an SQLite
+# R*Tree, so finding NGOs that cover an event is an index lookup, not a scan.
+NGO_SERVICE_RADIUS_DEG = 0.5  # roughly 50km
+
+def sync_ngo_rtree(ngo_id=None, after_id=None):
+    """Mirror NGO locations into ngo_rtree (one NGO, those with id > after_id,
+    or all of them)"""
+    sql = (
+        f"INSERT OR REPLACE INTO ngo_rtree (id, minLat, maxLat, minLon, maxLon) "
+        f"SELECT id, lat - :r, lat + :r, lon - :r, lon + :r FROM {NGO.__tablename__} "
+        f"WHERE lat IS NOT NULL AND lon IS NOT NULL"
+    )
+    params = {"r": NGO_SERVICE_RADIUS_DEG}
+    if ngo_id is not None:
+        sql += " AND id = :id"
+        params["id"] = ngo_id
+    elif after_id is not None:
+        sql += " AND id > :after_id"
+        params["after_id"] = after_id
+    db.session.execute(text(sql), params)
+
 with app.app_context():
     db.create_all()
+    db.session.execute(text(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS ngo_rtree "
+        "USING rtree(id, minLat, maxLat, minLon, maxLon)"
+    ))
+    sync_ngo_rtree()
+    db.session.commit()
 
 # ---- NGO Matching Logic ----
+# The NGO roster changes rarely, so a burst of alerts shares one lookup.
+# Cleared whenever an NGO is added. Per-process only - use Redis (SETEX) if
+# running several workers that must see new NGOs immediately.
+_ngo_cache = TTLCache(maxsize=1, ttl=60)
+_ngo_cache_lock = threading.Lock()
+
+def get_candidate_ngos():
+    """Fetch (and cache) the NGOs eligible for alerts as plain rows"""
+    with _ngo_cache_lock:
+        try:
+            return _ngo_cache['all']
+        except KeyError:
+            pass
+    # lambda_stmt caches the compiled SQL across calls
+    rows = db.session.execute(lambda_stmt(
+        lambda: select(NGO.id, NGO.name, NGO.phone).limit(10)
+    )).all()
+    with _ngo_cache_lock:
+        _ngo_cache['all'] = rows
+    return rows
+
+def invalidate_ngo_cache():
+    with _ngo_cache_lock:
+        _ngo_cache.pop('all', None)
+
+def find_nearby_ngos(lat, lon, limit=10):
+    """NGOs whose service area covers (lat, lon), nearest first"""
+    return db.session.execute(text(
+        f"SELECT n.id, n.name, n.phone FROM ngo_rtree r "
+        f"JOIN {NGO.__tablename__} n ON n.id = r.id "
+        f"WHERE r.minLat <= :lat AND r.maxLat >= :lat "
+        f"AND r.minLon <= :lon AND r.maxLon >= :lon "
+        f"ORDER BY (n.lat - :lat) * (n.lat - :lat) + (n.lon - :lon) * (n.lon - :lon) "
+        f"LIMIT :limit"
+    ), {"lat": lat, "lon": lon, "limit": limit}).all()
+
 def match_ngos_for_event(event_json):
     """Match NGOs based on services needed and proximity"""
     event_type = event_json.get('event_type', '')
     
-    # Get all active NGOs
-    ngos = NGO.query.all()
+    # Prefer NGOs near the event when the device reports its location
+    matched = []
+    try:
+        lat = float(event_json['lat'])
+        lon = float(event_json['lon'])
+    except (KeyError, TypeError, ValueError):
+        lat = lon = None
+    if lat is not None:
+        matched = find_nearby_ngos(lat, lon)
+        if not matched:
+            app.logger.info("No NGOs cover (%s, %s) - falling back to default list", lat, lon)
     
-    if not ngos:
-        print("WARNING: No NGOs registered in system!")
-        return []
+    # Otherwise return the first NGOs for any alert
+    # In production: filter by service type, capacity in SQL,
+    # e.g. .filter(NGO.services.contains(event_type)) before the limit
+    if not matched:
+        matched = get_candidate_ngos()
     
-    # For prototype: return all NGOs for any alert
-    # In production: filter by service type, location, capacity
-    matched = ngos[:10]  # Limit to 3 NGOs
+    if not matched:
+        app.logger.warning("No NGOs registered in system!")
+        return []
     
-    print(f"Matched {len(matched)} NGOs for event type: {event_type}")
+    app.logger.info("Matched %d NGOs for event type: %s", len(matched), event_type)
     return matched
 
 # ---- Notification System ----
@@ -63,9 +221,38 @@ TWILIO_SID = os.getenv("TWILIO_SID")
 TWILIO_TOKEN = os.getenv("TWILIO_TOKEN")
 TWILIO_FROM = os.getenv("TWILIO_FROM")
 
+# Shared client: pool_connections keeps one requests.Session so every SMS
+# after the first reuses the keep-alive connection to Twilio
+_twilio_client = Client(
+    TWILIO_SID, TWILIO_TOKEN,
+    http_client=TwilioHttpClient(pool_connections=True)
+) if TWILIO_SID else None
+
+@celery.task(name='main.send_sms', bind=True, max_retries=3)
+def send_sms(self, to, body, from_):
+    """Deliver a single SMS through Twilio (runs on the Celery worker)"""
+    if _twilio_client is None:
+        # The web process had TWILIO_SID but this worker's environment doesn't
+        app.logger.error("  ✗ Twilio not configured on this worker (TWILIO_SID unset) - SMS to %s not sent", to)
+        raise RuntimeError("TWILIO_SID is not set in the Celery worker environment")
+    try:
+        _twilio_client.messages.create(body=body, from_=from_, to=to)
+        app.logger.info("  ✓ SMS sent successfully to %s", to)
+    except TwilioRestException as e:
+        if e.status == 429:
+            # Throttled - back off 1s, 2s, 4s (capped at 16s) and try again
+            app.logger.warning("  ⏳ Twilio throttled SMS to %s, retrying", to)
+            raise self.retry(exc=e, countdown=min(2 ** self.request.retries, 16))
+        app.logger.error("  ✗ Twilio error: %s", e)
+        raise
+    except Exception as e:
+        app.logger.error("  ✗ Twilio error: %s", e)
+        raise
+
 def notify_ngos(ngos, event):
     """Send notifications to matched NGOs"""
     msgs = []
+    sms = []
     
     for ngo in ngos:
         # Create alert message
@@ -77,25 +264,27 @@ def notify_ngos(ngos, event):
         else:
             text = f"⚠️ NOTIFICATION: Motion detected at {device_id}. Monitoring situation."
         
-        print(f"→ Notifying {ngo.name} ({ngo.phone}): {text}")
+        app.logger.info("→ Notifying %s (%s): %s", ngo.name, ngo.phone, text)
         msgs.append({"ngo": ngo.name, "phone": ngo.phone, "message": text})
         
-        # Send SMS if Twilio is configured
+        # Queue SMS if Twilio is configured
         if TWILIO_SID and ngo.phone:
-            try:
-                client = Client(TWILIO_SID, TWILIO_TOKEN)
-                client.messages.create(
-                    body=text,
-                    from_=TWILIO_FROM,
-                    to=ngo.phone
-                )
-                print(f"  ✓ SMS sent successfully")
-            except Exception as e:
-                print(f"  ✗ Twilio error: {e}")
+            sms.append(send_sms.s(ngo.phone, text, TWILIO_FROM))
+    
+    # Enqueue every SMS for this alert in one batch
+    if sms:
+        try:
+            group(sms).apply_async()
+            app.logger.info("  ✓ %d SMS queued", len(sms))
+        except Exception as e:
+            app.logger.error("  ✗ Could not queue SMS: %s", e)
     
     return msgs
 
 # ---- API Endpoints ----
+EVENT_DEBOUNCE_SECONDS = 2  # matches serialbridge's MIN_INTERVAL
+EVENT_RETRANSMIT_WINDOW = timedelta(minutes=10)  # how far back to look for a resent reading
+
 @app.route("/api/event", methods=["POST"])
 def receive_event():
     """Receive sensor event and notify NGOs"""
@@ -107,57 +296,90 @@ def receive_event():
     # Fix timestamp: use server time if not provided
     timestamp = datetime.utcnow()
     
-    print(f"\n📥 Received event: {event_type} from {device_id}")
-    
-    # Save event to database
-    ev = Event(
-        device_id=device_id,
-        event_type=event_type,
-        raw=str(data),
-        created_at=timestamp
-    )
-    db.session.add(ev)
-    db.session.commit()
+    app.logger.info("📥 Received event: %s from %s", event_type, device_id)
     
     # IMPORTANT: Only notify NGOs for critical alerts (not every motion detection)
     should_notify = event_type == "possible_encampment"
     
+    # Save event to database with a Core INSERT - this is the hottest write path,
+    # so skip the ORM unit-of-work bookkeeping. The INSERT ... SELECT ... WHERE
+    # NOT EXISTS drops duplicates atomically, so concurrent posts can't both pass.
+    values = {
+        Event.device_id: device_id,
+        Event.event_type: event_type,
+        Event.raw: orjson.dumps(data).decode(),  # compact JSON, parseable later
+        Event.created_at: timestamp,
+        Event.status: "new",
+    }
+    same_source = [Event.device_id == device_id, Event.event_type == event_type]
+    sensor_ts = data.get("timestamp_ms")
+    if isinstance(sensor_ts, (int, float)) and not isinstance(sensor_ts, bool):
+        # A duplicate is a resend of the same reading. Readings buffered by
+        # serialbridge arrive back to back but keep their own timestamps.
+        stored_ts = case((func.json_valid(Event.raw), func.json_extract(Event.raw, '$.timestamp_ms')))
+        duplicate = exists().where(
+            *same_source,
+            Event.created_at > timestamp - EVENT_RETRANSMIT_WINDOW,
+            stored_ts == sensor_ts
+        )
+    else:
+        # No sensor timestamp - fall back to debouncing on arrival time
+        duplicate = exists().where(
+            *same_source,
+            Event.created_at > timestamp - timedelta(seconds=EVENT_DEBOUNCE_SECONDS)
+        )
+    result = db.session.execute(insert(Event).from_select(
+        list(values),
+        select(*[literal(v, col.type) for col, v in values.items()]).where(~duplicate)
+    ))
+    
+    if result.rowcount == 0:
+        db.session.rollback()
+        app.logger.info("  (Deduped - %s from %s already received)", event_type, device_id)
+        return jsonify({
+            "status": "deduped",
+            "message": "Duplicate event ignored"
+        })
+    event_id = result.lastrowid
+    
+    # Match only events that were actually stored; the result joins the same commit
+    ngos = []
     if should_notify:
-        print("🔔 Critical alert detected - matching NGOs...")
-        
-        # Match NGOs
+        app.logger.info("🔔 Critical alert detected - matching NGOs...")
         ngos = match_ngos_for_event(data)
-        
         if ngos:
-            # Send notifications
+            db.session.execute(update(Event).where(Event.id == event_id).values(
+                matched_ngos=",".join([str(n.id) for n in ngos]),
+                status="notified"
+            ))
+    db.session.commit()
+    
+    if should_notify:
+        if ngos:
+            # Only text NGOs once the event is stored - a failed insert must not
+            # send SMS that a client retry would then send again
             notified = notify_ngos(ngos, data)
-            
-            # Update event with matched NGOs
-            ev.matched_ngos = ",".join([str(n.id) for n in ngos])
-            ev.status = "notified"
-            db.session.commit()
-            
-            print(f"✓ Event #{ev.id} - Notified {len(ngos)} NGOs")
+            app.logger.info("✓ Event #%s - Notified %d NGOs", event_id, len(ngos))
             
             return jsonify({
                 "status": "ok",
-                "event_id": ev.id,
+                "event_id": event_id,
                 "notified": notified,
                 "message": f"Alert sent to {len(ngos)} NGOs"
             })
         else:
-            print("⚠️ No NGOs available to notify!")
+            app.logger.warning("⚠️ No NGOs available to notify!")
             return jsonify({
                 "status": "warning",
-                "event_id": ev.id,
+                "event_id": event_id,
                 "message": "Event saved but no NGOs registered"
             })
     else:
         # Just log the event, don't notify
-        print(f"✓ Event #{ev.id} logged (no notification needed)")
+        app.logger.info("✓ Event #%s logged (no notification needed)", event_id)
         return jsonify({
             "status": "ok",
-            "event_id": ev.id,
+            "event_id": event_id,
             "message": "Event logged"
         })
 
@@ -166,45 +388,76 @@ def receive_event():
 def ngos():
     if request.method == "POST":
         j = request.get_json()
+        if isinstance(j, list):
+            # Bulk ingest: one executemany INSERT and one commit for the batch
+            rows = [{
+                "name": x['name'],
+                "phone": x.get('phone'),
+                "email": x.get('email'),
+                "lat": x.get('lat'),
+                "lon": x.get('lon'),
+                "services": x.get('services', '')
+            } for x in j]
+            if rows:
+                # Only the rows added here need mirroring into the R*Tree
+                prev_max_id = db.session.execute(select(func.max(NGO.id))).scalar() or 0
+                db.session.execute(insert(NGO), rows)
+                sync_ngo_rtree(after_id=prev_max_id)
+                db.session.commit()
+                invalidate_ngo_cache()
+            app.logger.info("✓ Added %d NGOs", len(rows))
+            return jsonify({"inserted": len(rows)})
         n = NGO(
             name=j['name'],
             phone=j.get('phone'),
             email=j.get('email'),
+            lat=j.get('lat'),
+            lon=j.get('lon'),
             services=j.get('services', '')
         )
         db.session.add(n)
+        db.session.flush()
+        sync_ngo_rtree(n.id)
         db.session.commit()
-        print(f"✓ Added NGO: {n.name} (ID: {n.id})")
+        invalidate_ngo_cache()
+        app.logger.info("✓ Added NGO: %s (ID: %s)", n.name, n.id)
         return jsonify({"id": n.id, "name": n.name})
     else:
-        ngo_list = NGO.query.all()
+        # Plain rows instead of ORM objects - we only serialize a few columns
+        rows = NGO.query.with_entities(NGO.id, NGO.name, NGO.phone, NGO.email).all()
         return jsonify([{
-            "id": n.id,
-            "name": n.name,
-            "phone": n.phone,
-            "email": n.email
-        } for n in ngo_list])
+            "id": r.id,
+            "name": r.name,
+            "phone": r.phone,
+            "email": r.email
+        } for r in rows])
 
 @app.route("/admin/events")
 def list_events():
-    evs = Event.query.order_by(Event.created_at.desc()).limit(50).all()
+    rows = db.session.execute(lambda_stmt(
+        lambda: select(
+            Event.id, Event.device_id, Event.event_type,
+            Event.created_at, Event.status, Event.matched_ngos
+        ).order_by(Event.created_at.desc()).limit(50)
+    )).all()
     return jsonify([{
-        "id": e.id,
-        "device_id": e.device_id,
-        "event_type": e.event_type,
-        "created_at": e.created_at.isoformat(),
-        "status": e.status,
-        "matched_ngos": e.matched_ngos
-    } for e in evs])
+        "id": r.id,
+        "device_id": r.device_id,
+        "event_type": r.event_type,
+        "created_at": r.created_at.isoformat(),
+        "status": r.status,
+        "matched_ngos": r.matched_ngos
+    } for r in rows])
 
 
 @app.route("/")
 def index():
     """Serve the simple dashboard UI"""
     try:
-        return render_template('index.html')
-    except Exception:
-        # Fall back to a minimal message if templates aren't available
+        # index.html is fully static - skip Jinja and let browsers cache it
+        return send_from_directory(app.static_folder, 'index.html', max_age=300)
+    except NotFound:
+        # Fall back to a minimal message if the dashboard isn't available
         return (
             "<h1>Homeless Assistance Backend</h1>"
             "<p>API available under /api and /admin endpoints.</p>"
@@ -216,7 +469,7 @@ def clear_events():
     try:
         num_deleted = Event.query.delete()
         db.session.commit()
-        print(f"🗑️ Cleared {num_deleted} events from database")
+        app.logger.info("🗑️ Cleared %d events from database", num_deleted)
         return jsonify({
             "status": "ok",
             "deleted": num_deleted,
@@ -229,9 +482,16 @@ def clear_events():
 @app.route("/admin/stats")
 def stats():
     """Get system statistics"""
-    total_events = Event.query.count()
-    total_ngos = NGO.query.count()
-    active_alerts = Event.query.filter_by(status="notified").count()
+    # Both event counts come from one pass over the events table
+    total_events, active_alerts = db.session.execute(lambda_stmt(
+        lambda: select(
+            func.count(Event.id),
+            func.coalesce(func.sum(case((Event.status == "notified", 1), else_=0)), 0)
+        )
+    )).one()
+    total_ngos = db.session.execute(lambda_stmt(
+        lambda: select(func.count(NGO.id))
+    )).scalar()
     
     return jsonify({
         "total_events": total_events,
@@ -240,12 +500,8 @@ def stats():
     })
 
 if __name__ == "__main__":
-    print("🚀 Starting Homeless Assistance Backend")
-    print("📍 Server: http://127.0.0.1:5000")
-    print("=" * 50)
-    app.run(debug=True, host="0.0.0.0")
-
-
-@app.route("/")
-def index():
-    return "index.html"
+    # Development only - in production run: gunicorn -c gunicorn.conf.py main:app
+    app.logger.info("🚀 Starting Homeless Assistance Backend")
+    app.logger.info("📍 Server: http://127.0.0.1:5000")
+    app.logger.info("=" * 50)
+    app.run(debug=os.getenv("FLASK_DEBUG") == "1", host="0.0.0.0")
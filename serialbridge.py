@@ -1,21 +1,49 @@
 import serial
 import time
-import json
+import orjson
+import queue
+import threading
 import requests
+from requests.adapters import HTTPAdapter
 
 SERIAL_PORT = "/dev/cu.usbmodem101"   # change to port, set to None to auto-detect
 BAUD = 115200
 BACKEND_URL = "http://127.0.0.1:5000/api/event"  # Flask server
 MIN_INTERVAL = 2  # Minimum seconds between events
+QUEUE_SIZE = 1000  # Events buffered while the backend is slow
+MAX_RETRIES = 3  # Retries on 429/5xx, with exponential backoff
 
 last_event_time = 0
 
+# One keep-alive session for the life of the bridge instead of a new
+# connection per event
+_session = requests.Session()
+_session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+_session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+
 def send_to_backend(payload):
-    try:
-        r = requests.post(BACKEND_URL, json=payload, timeout=5)
-        print("POST", r.status_code, r.text)
-    except Exception as e:
-        print("Error posting to backend:", e)
+    delay = 1
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            r = _session.post(BACKEND_URL, data=orjson.dumps(payload),
+                              headers={'Content-Type': 'application/json'}, timeout=5)
+            print("POST", r.status_code, r.text)
+            if r.status_code != 429 and r.status_code < 500:
+                return
+        except Exception as e:
+            print("Error posting to backend:", e)
+        if attempt < MAX_RETRIES:
+            time.sleep(delay)
+            delay = min(delay * 2, 16)
+
+def sender_worker(q):
+    """Post queued events so HTTP never blocks the serial read loop"""
+    while True:
+        payload = q.get()
+        try:
+            send_to_backend(payload)
+        finally:
+            q.task_done()
 
 def run():
     global last_event_time
@@ -88,19 +116,24 @@ def run():
     
     print(f"Connected to {chosen}")
     time.sleep(2)  # wait for Arduino reset
+
+    q = queue.Queue(maxsize=QUEUE_SIZE)
+    threading.Thread(target=sender_worker, args=(q,), daemon=True).start()
     
     while True:
         try:
-            line = ser.readline().decode(errors="ignore").strip()
-            if not line:
+            # Strip as bytes first so empty/keep-alive lines never get decoded
+            raw = ser.readline().strip()
+            if not raw:
                 continue
+            line = raw.decode("utf-8", "ignore")
             
             print("Serial:", line)
 
             # Attempt to parse JSON; fallback to raw line
             try:
-                payload = json.loads(line)
-            except json.JSONDecodeError:
+                payload = orjson.loads(line)
+            except orjson.JSONDecodeError:
                 payload = {"raw": line}
 
             payload.setdefault("device_id", "ELEGOO_PROTO_01")
@@ -113,7 +146,10 @@ def run():
                 continue
 
             last_event_time = current_time
-            send_to_backend(payload)
+            try:
+                q.put_nowait(payload)
+            except queue.Full:
+                print("  (Dropped - send queue full)")
             
         except KeyboardInterrupt:
             print("\nStopping bridge")